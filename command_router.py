@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+# Precondition costs, cheaper checks always run first
+COST_LOCAL = 0
+COST_STORE = 1
+COST_NETWORK = 2
+
+
+class Precondition:
+    """
+    A check that must pass before a command is executed
+    """
+
+    def __init__(self, name, check, cost=COST_LOCAL, requires=()):
+        """
+        :param name: Unique name of the check, used to reuse its result within the same update
+        :param check: Callable that receives the CommandContext and returns None if the check passed,
+                      the error message to show to the user otherwise
+        :param cost: One of COST_LOCAL, COST_STORE or COST_NETWORK
+        :param requires: The Precondition list that must pass before this check can run
+        """
+        self.name = name
+        self.check = check
+        self.cost = cost
+        self.requires = list(requires)
+
+
+class Command:
+    """
+    A bot command with the preconditions it requires
+    """
+
+    def __init__(self, name, callback, preconditions=()):
+        """
+        :param name: The command name, without the leading /
+        :param callback: Callable that receives the update and the CommandContext
+        :param preconditions: The Precondition list the command requires, in any order
+        """
+        self.name = name
+        self.callback = callback
+        self.preconditions = self._sort_preconditions(preconditions)
+
+    def _sort_preconditions(self, preconditions):
+        """
+        Order the preconditions cheapest first, running every check after the ones it requires
+        :param preconditions: The Precondition list the command requires
+        :return: The ordered Precondition list
+        """
+        names = set(precondition.name for precondition in preconditions)
+        for precondition in preconditions:
+            for required in precondition.requires:
+                if required.name not in names:
+                    raise ValueError("/" + self.name + ": precondition " + precondition.name +
+                                     " requires " + required.name)
+        # Stable sort: checks with the same cost keep the declared order
+        remaining = sorted(preconditions, key=lambda precondition: precondition.cost)
+        ordered = []
+        ordered_names = set()
+        while remaining:
+            for precondition in remaining:
+                if all(required.name in ordered_names for required in precondition.requires):
+                    break
+            else:
+                raise ValueError("/" + self.name + ": circular precondition requirements")
+            remaining.remove(precondition)
+            ordered.append(precondition)
+            ordered_names.add(precondition.name)
+        return ordered
+
+
+class CommandContext:
+    """
+    Data about a single update, shared between middlewares, preconditions and the command
+    """
+
+    def __init__(self, update, command, args_text, args_markdown):
+        """
+        :param update: an object that represents an incoming update.
+        :param command: The Command being executed, None if unknown
+        :param args_text: The command arguments (plain text after the command)
+        :param args_markdown: The command arguments (markdown text after the command)
+        """
+        self.update = update
+        self.message = update.message
+        self.command = command
+        self.args_text = args_text
+        self.args_markdown = args_markdown
+        self._results = {}
+
+    def memo(self, key, compute):
+        """
+        Return the value cached for the given key, computing it the first time
+        :param key: The cache key
+        :param compute: Callable without arguments that computes the value
+        :return: The cached value
+        """
+        if key not in self._results:
+            self._results[key] = compute()
+        return self._results[key]
+
+
+def parse_command(text, bot_username=None):
+    """
+    Extract the command name from the given message text.
+    "/cmd", "/cmd args" and "/cmd@botname args" are accepted, commands addressed to other bots are ignored
+    :param text: The message text
+    :param bot_username: The username of this bot
+    :return: The lowercase command name, None if the text is not a command for this bot
+    """
+    if not text or not text.startswith("/"):
+        return None
+    token = text.split(None, 1)[0][1:]
+    if "@" in token:
+        token, target = token.split("@", 1)
+        if bot_username is not None and target.lower() != bot_username.lower():
+            return None
+    if not token:
+        return None
+    return token.lower()
+
+
+class PreconditionMiddleware:
+    """
+    Middleware that checks the command preconditions, cheapest first, stopping the chain at the first failure
+    """
+
+    def __init__(self, on_rejected):
+        """
+        :param on_rejected: Callable (update, error message) called when a precondition fails
+        """
+        self.on_rejected = on_rejected
+
+    def __call__(self, context, next_handler):
+        if context.command is not None:
+            for precondition in context.command.preconditions:
+                error = context.memo(precondition.name, lambda: precondition.check(context))
+                if error is not None:
+                    self.on_rejected(context.update, error)
+                    return
+        next_handler(context)
+
+
+class CommandRouter:
+    """
+    Dispatch the commands by exact name through a middleware chain.
+    Every middleware receives the CommandContext and the next handler to call;
+    the end of the chain runs the command.
+    """
+
+    def __init__(self, on_unknown):
+        """
+        :param on_unknown: Callable (update) called for unknown commands
+        """
+        self.on_unknown = on_unknown
+        self.bot_username = None
+        self.commands = {}
+        self.middlewares = []
+
+    def register(self, name, callback, preconditions=()):
+        """
+        Register a command
+        :param name: The command name, without the leading /
+        :param callback: Callable that receives the update and the CommandContext
+        :param preconditions: The Precondition list the command requires
+        """
+        self.commands[name.lower()] = Command(name.lower(), callback, preconditions)
+
+    def use(self, middleware):
+        """
+        Append a middleware to the chain
+        :param middleware: Callable (context, next_handler), it must call next_handler(context) to continue
+        """
+        self.middlewares.append(middleware)
+
+    def dispatch(self, update):
+        """
+        Run the command contained in the given update, if any
+        :param update: an object that represents an incoming update.
+        :return: True if the update contained a command for this bot, False otherwise
+        """
+        name = parse_command(update.message.text, self.bot_username)
+        if name is None:
+            return False
+        context = CommandContext(update, self.commands.get(name),
+                                 self._get_args(update.message.text), self._get_args(update.message.text_markdown))
+        self._call_chain(context, 0)
+        return True
+
+    @staticmethod
+    def _get_args(text):
+        """
+        Return the text following the command
+        :param text: The message text
+        :return: The command arguments, an empty string if there are none
+        """
+        splitted_text = (text or "").split(None, 1)
+        return splitted_text[1].strip() if len(splitted_text) > 1 else ""
+
+    def _call_chain(self, context, index):
+        """
+        Call the middleware at the given index, or the command itself at the end of the chain
+        :param context: The CommandContext of the update
+        :param index: The index of the middleware to call
+        """
+        if index < len(self.middlewares):
+            self.middlewares[index](context, lambda next_context: self._call_chain(next_context, index + 1))
+        else:
+            self._run_command(context)
+
+    def _run_command(self, context):
+        """
+        Run the command, the end of the middleware chain
+        :param context: The CommandContext of the update
+        """
+        if context.command is None:
+            self.on_unknown(context.update)
+            return
+        context.command.callback(context.update, context)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import sqlite3
+import time
+import uuid
+
+from threading import Event, Lock, Thread
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+SQL_SELECT_LEASE = "SELECT holder, expires_at FROM leases WHERE name = ?"
+SQL_UPSERT_LEASE = "INSERT OR REPLACE INTO leases (name, holder, expires_at) VALUES (?, ?, ?)"
+SQL_RELEASE_LEASE = "UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ?"
+
+
+class LeaderElector:
+    """
+    Lease based leader election between bot replicas sharing the same SQLite database.
+    The leader renews its lease every renew_interval seconds, the other replicas try to take it
+    over at the same pace once it is expired, so a failover takes at most lease_seconds + renew_interval.
+    """
+
+    def __init__(self, database_file_name, logger_ref, lease_name="marvin", lease_seconds=15, renew_interval=None):
+        """
+        :param database_file_name: Path of the SQLite database file shared by the replicas
+        :param logger_ref: The logger to use
+        :param lease_name: The name of the lease, replicas competing for the same role must use the same name
+        :param lease_seconds: Seconds a lease lasts without being renewed
+        :param renew_interval: Seconds between two renew/acquire attempts (lease_seconds / 3 by default),
+                               it must be lower than lease_seconds
+        :raises ValueError: If renew_interval is not lower than lease_seconds
+        """
+        self.logger = logger_ref
+        self.lease_name = lease_name
+        self.lease_seconds = lease_seconds
+        self.renew_interval = renew_interval if renew_interval is not None else lease_seconds / 3
+        # Otherwise the local deadline expires before the lease is renewed, and the leader steps down every cycle
+        if self.renew_interval >= lease_seconds:
+            raise ValueError("renew_interval (" + str(self.renew_interval) + ") must be lower than lease_seconds (" +
+                             str(lease_seconds) + ")")
+        # Unique id of this replica
+        self.replica_id = socket.gethostname() + ":" + str(os.getpid()) + ":" + uuid.uuid4().hex[:8]
+        # The lease must be written immediately, so this connection doesn't go through the StateStore batching
+        self._connection = sqlite3.connect(database_file_name, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.executescript(SCHEMA)
+        self._lock = Lock()
+        # Local monotonic deadline of the held lease, used to step down even if the database is unreachable
+        self._lease_deadline = 0
+        self._elected_event = Event()
+        self._stop_event = Event()
+        self._thread = Thread(target=self._election_loop, name="leader-election", daemon=True)
+
+    @property
+    def is_leader(self):
+        """
+        :return: True if this replica currently holds a valid lease
+        """
+        if self._elected_event.is_set() and time.monotonic() >= self._lease_deadline:
+            self._set_leader(False)
+        return self._elected_event.is_set()
+
+    def start(self):
+        """
+        Try to acquire the lease and start the background renew thread
+        """
+        self._try_acquire()
+        self._thread.start()
+
+    def wait_for_leadership(self, timeout=None):
+        """
+        Block until this replica becomes the leader
+        :param timeout: Max seconds to wait, None to wait forever
+        :return: True if this replica is the leader
+        """
+        self._elected_event.wait(timeout)
+        return self.is_leader
+
+    def stop(self):
+        """
+        Stop the renew thread and release the lease, so another replica can take over immediately
+        """
+        self._stop_event.set()
+        with self._lock:
+            if self._elected_event.is_set():
+                try:
+                    self._connection.execute(SQL_RELEASE_LEASE, (self.lease_name, self.replica_id))
+                except sqlite3.Error as e:
+                    self.logger.warning("Unable to release the leader lease!", exc_info=e)
+                self._set_leader(False)
+            self._connection.close()
+
+    def _try_acquire(self):
+        """
+        Acquire the lease if free or expired, renew it if already held
+        """
+        with self._lock:
+            if self._stop_event.is_set():
+                return
+            now = time.time()
+            started = time.monotonic()
+            try:
+                self._connection.execute("BEGIN IMMEDIATE")
+                try:
+                    row = self._connection.execute(SQL_SELECT_LEASE, (self.lease_name,)).fetchone()
+                    acquired = row is None or row[0] == self.replica_id or row[1] < now
+                    if acquired:
+                        self._connection.execute(SQL_UPSERT_LEASE,
+                                                 (self.lease_name, self.replica_id, now + self.lease_seconds))
+                    self._connection.execute("COMMIT")
+                except sqlite3.Error:
+                    self._connection.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as e:
+                # Keep the current role until the local deadline expires, is_leader steps down after it
+                self.logger.warning("Unable to update the leader lease!", exc_info=e)
+                return
+            if acquired:
+                self._lease_deadline = started + self.lease_seconds
+            self._set_leader(acquired)
+
+    def _set_leader(self, leader):
+        """
+        Update the local role, logging every change
+        :param leader: True if this replica holds the lease
+        """
+        if leader and not self._elected_event.is_set():
+            self.logger.info("Replica " + self.replica_id + " is now the leader")
+            self._elected_event.set()
+        elif not leader and self._elected_event.is_set():
+            self.logger.info("Replica " + self.replica_id + " is no longer the leader")
+            self._elected_event.clear()
+
+    def _election_loop(self):
+        """
+        Background thread that renews or tries to acquire the lease
+        """
+        while not self._stop_event.wait(self.renew_interval):
+            self._try_acquire()
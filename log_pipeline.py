@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import copy
+import datetime
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] - %(message)s'
+
+# Extra attributes, passed with logger.info(..., extra={...}), copied in the JSON lines
+JSON_EXTRA_FIELDS = ("command", "duration_ms", "submission_id")
+
+_correlation = threading.local()
+
+
+def set_correlation_id(correlation_id):
+    """
+    Set the correlation id added to every log record emitted by the current thread
+    :param correlation_id: The id of the update (or job) being handled, None to clear it
+    """
+    _correlation.id = correlation_id
+
+
+def get_correlation_id():
+    """
+    :return: The correlation id of the current thread, "-" if not set
+    """
+    correlation_id = getattr(_correlation, "id", None)
+    return correlation_id if correlation_id is not None else "-"
+
+
+class CorrelationFilter(logging.Filter):
+    """
+    Add the correlation id of the emitting thread to every record.
+    It must run in the emitting thread, so it is attached to the QueueHandler
+    """
+
+    def filter(self, record):
+        record.correlation_id = get_correlation_id()
+        return True
+
+
+class StructuredQueueHandler(QueueHandler):
+    """
+    QueueHandler that keeps the traceback apart from the message, so the JSON lines can store it in its own field
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format every record as a single JSON line
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "correlation_id": getattr(record, "correlation_id", "-"),
+            "message": record.getMessage(),
+        }
+        for field in JSON_EXTRA_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def _compressed_name(default_name):
+    """
+    Name of the rotated log files
+    :param default_name: The name chosen by the rotating handler
+    :return: The name with the gzip extension
+    """
+    return default_name + ".gz"
+
+
+def _compress_rotated_file(source, dest):
+    """
+    Compress the rotated log file with gzip, removing the original one
+    :param source: The file being rotated
+    :param dest: The name of the compressed file
+    """
+    with open(source, "rb") as source_file, gzip.open(dest, "wb") as dest_file:
+        shutil.copyfileobj(source_file, dest_file)
+    os.remove(source)
+
+
+def setup_logging(log_dir, level=logging.INFO, json_format=False, max_bytes=10 * 1024 * 1024, backup_count=10,
+                  when=None):
+    """
+    Configure the root logger to write through a queue: the calling threads only enqueue the records,
+    a background thread writes them to the console and to a rotating, gzip compressed, log file
+    :param log_dir: The directory of the log files
+    :param level: The minimum level to log
+    :param json_format: True to write the file as JSON lines, False for the plain text format
+    :param max_bytes: Size in bytes that triggers the file rotation (ignored if when is set)
+    :param backup_count: Number of rotated files to keep
+    :param when: Time based rotation interval (see TimedRotatingFileHandler, e.g. "midnight"), None to rotate by size
+    :return: The started QueueListener, stop it before exiting to write the queued records
+    """
+    if json_format:
+        file_name = os.path.join(log_dir, "marvin.jsonl")
+        file_formatter = JsonFormatter()
+    else:
+        file_name = os.path.join(log_dir, "marvin.log")
+        file_formatter = logging.Formatter(TEXT_FORMAT)
+
+    if when is not None:
+        file_handler = TimedRotatingFileHandler(file_name, when=when, backupCount=backup_count, encoding="utf-8")
+    else:
+        file_handler = RotatingFileHandler(file_name, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    file_handler.namer = _compressed_name
+    file_handler.rotator = _compress_rotated_file
+    file_handler.setLevel(level)
+    file_handler.setFormatter(file_formatter)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(level)
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.Queue(-1)
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationFilter())
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(level)
+
+    listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
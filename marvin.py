@@ -4,17 +4,25 @@ import json
 import logging
 import requests
 import io
-import datetime
 import pickle
+import re
+import time
 
+from functools import partial
 from threading import Thread
 from praw import Reddit, exceptions, models
+from prawcore import Forbidden, NotFound
 from lxml.html import fromstring
 from urllib import parse as urlparse
 from urllib.parse import unquote
 from telegram import MessageEntity, ChatMember, Chat, TelegramError
 from telegram.ext import MessageHandler, Updater
-from time import sleep
+from time import sleep, perf_counter
+from state_store import StateStore
+from leader_election import LeaderElector
+from command_router import CommandRouter, Precondition, PreconditionMiddleware, COST_STORE, COST_NETWORK
+from log_pipeline import setup_logging, set_correlation_id
+from moderation_queue import ModerationQueue, ProgressTracker
 
 
 class MarvinBot:
@@ -25,6 +33,14 @@ class MarvinBot:
     cookie_cache_file_name = "content/cookies.pkl"
     word_blacklist_file_name = "content/words_blacklist.json"
     auto_pinned_posts_file_name = "content/auto_pinned_posts.json"
+    state_database_file_name = "content/marvin.db"
+    # Seconds between two reddit stream fetches without new posts, and before restarting a failed stream
+    stream_poll_interval = 5
+    stream_retry_delay = 10
+    # Bulk /delrule targets: "u/<user>" followed by a time window like "30m", "2h" or "1d"
+    user_target_regex = re.compile(r"^/?u/([A-Za-z0-9_-]+)$")
+    time_window_regex = re.compile(r"^(\d+)([mhd])$")
+    time_window_units = {"m": 60, "h": 3600, "d": 86400}
 
     def __init__(self, logger_ref):
         # The subreddit where the bot must post
@@ -51,8 +67,14 @@ class MarvinBot:
         self.session = None
         # Telegram Updater - telegram.ext.Updater
         self.updater = None
-        # Groups in which messages come from
-        self.tg_groups = {}
+        # SQLite store for cookies, chat permissions, checkpoints, titles and message <-> submission map
+        self.state_store = None
+        # Leader election between replicas, only the leader consumes the reddit stream
+        self.leader = None
+        # Concurrent, rate limited queue used by the bulk moderation commands
+        self.moderation_queue = None
+        # Command registry, dispatches the commands through the precondition middleware chain
+        self.router = CommandRouter(self.unknown_command)
         # List of autopinned posts
         self.posts_to_pin = []
 
@@ -74,18 +96,19 @@ class MarvinBot:
             video_id = page_url[17:]
             return self.get_youtube_title_from_url(video_id)
 
+        cached_title = self.state_store.get_title(page_url)
+        if cached_title is not None:
+            return cached_title
+
         r = self.session.get(page_url)
 
         # Update cookie cache:
-        try:
-            with open(self.cookie_cache_file_name, "wb") as f:
-                pickle.dump(self.session.cookies, f)
-        except Exception as e:
-            self.logger.warning("Unable to update cached cookies!", exc_info=e)
+        self.state_store.save_cookies(self.session.cookies)
 
         tree = fromstring(r.content)
         title = tree.findtext('.//title')
         if title is not None:
+            self.state_store.set_title(page_url, str(title))
             return str(title)
         else:
             return None
@@ -150,25 +173,17 @@ class MarvinBot:
         :param seconds_delay: delay of the delete (in seconds)
         """
 
-        if tg_group.id not in self.tg_groups:
-            self.tg_groups[tg_group.id] = tg_group
+        is_admin = self.state_store.get_chat_admin(tg_group.id)
+        if is_admin is None:
             is_admin = self.is_sender_admin(self.updater.bot, tg_group.id, self.updater.bot.id)
-            self.tg_groups[tg_group.id].is_admin = is_admin
-            if is_admin:
-                if seconds_delay > 0:
-                    delete_thread = Thread(target=self.delete_message_with_delay,
-                                           args=[tg_group.id, message_id, seconds_delay])
-                    delete_thread.start()
-                else:
-                    self.updater.bot.delete_message(tg_group.id, message_id)
-        else:
-            if self.tg_groups[tg_group.id].is_admin:
-                if seconds_delay > 0:
-                    delete_thread = Thread(target=self.delete_message_with_delay,
-                                           args=[tg_group.id, message_id, seconds_delay])
-                    delete_thread.start()
-                else:
-                    self.updater.bot.delete_message(tg_group.id, message_id)
+            self.state_store.set_chat_admin(tg_group.id, is_admin)
+        if is_admin:
+            if seconds_delay > 0:
+                delete_thread = Thread(target=self.delete_message_with_delay,
+                                       args=[tg_group.id, message_id, seconds_delay])
+                delete_thread.start()
+            else:
+                self.updater.bot.delete_message(tg_group.id, message_id)
         return
 
     def is_message_in_correct_group(self, chat: Chat):
@@ -179,6 +194,23 @@ class MarvinBot:
         """
         return chat.id == self.authorized_group_id
 
+    @staticmethod
+    def get_reddit_submission_id(url):
+        """
+        Function that return the id of the reddit post the given url points to
+        :param url: The url to parse
+        :return: The id of the post, None if the url is not a reddit post url
+        """
+        if not urlparse.urlparse(url).scheme:
+            url = "https://" + url
+        host = urlparse.urlparse(url).netloc.lower()
+        if host != "redd.it" and host != "reddit.com" and not host.endswith(".reddit.com"):
+            return None
+        try:
+            return models.Submission.id_from_url(url)
+        except exceptions.ClientException:
+            return None
+
     def add_default_comment(self, post_submission, tg_msg_id):
         """
         Function that add the default comment to the given post submission
@@ -239,14 +271,227 @@ class MarvinBot:
                                           text=text_to_send)
         return
 
+    def reject_command(self, update, text):
+        """
+        Delete the command message and explain the user why it has been rejected
+        :param update: an object that represents an incoming update.
+        :param text: The reason the command has been rejected
+        """
+        self.delete_message_if_admin(update.message.chat, update.message.message_id)
+        self.send_tg_message_reply_or_private(update, text)
+
+    # ---------------------------------------------
+    # Command preconditions
+    # ---------------------------------------------
+
+    def check_authorized_group(self, context):
+        """
+        Precondition: the command has been used in the authorized group
+        :param context: The CommandContext of the update
+        :return: None if the check passed, the error message otherwise
+        """
+        if self.is_message_in_correct_group(context.message.chat):
+            return None
+        return "Spiacente, questo bot funziona solo nel" \
+               "gruppo autorizzato con id " + \
+               str(self.authorized_group_id) + " (" + str(self.tg_group) + ")" + \
+               ", non in " + \
+               str(context.message.chat.id) + " (attuale)"
+
+    @staticmethod
+    def check_is_reply(context):
+        """
+        Precondition: the command is used as reply to another message
+        :param context: The CommandContext of the update
+        :return: None if the check passed, the error message otherwise
+        """
+        if context.message.reply_to_message:
+            return None
+        return "Per usare /" + context.command.name + " devi rispondere ad un messaggio"
+
+    @staticmethod
+    def get_reply_urls(context):
+        """
+        Return the urls contained in the replied message, parsed only once per update
+        :param context: The CommandContext of the update
+        :return: The list of urls
+        """
+        return context.memo("reply_urls",
+                            lambda: list(context.message.reply_to_message.parse_entities([MessageEntity.URL]).values()))
+
+    def check_reply_has_single_url(self, context):
+        """
+        Precondition: the replied message contains exactly one url
+        :param context: The CommandContext of the update
+        :return: None if the check passed, the error message otherwise
+        """
+        urls = self.get_reply_urls(context)
+        if not urls:
+            return "Il messaggio originale deve contenere una URL"
+        if len(urls) > 1:
+            return "Il messaggio originale deve contenere una **sola** URL"
+        return None
+
+    def check_reply_to_submission(self, context):
+        """
+        Precondition: the replied message refers to a reddit post.
+        The message <-> submission map is checked first, the url in the message is parsed otherwise.
+        The post id is saved in context.submission_id
+        :param context: The CommandContext of the update
+        :return: None if the check passed, the error message otherwise
+        """
+        reply_message = context.message.reply_to_message
+        context.submission_id = self.state_store.get_message_submission(reply_message.chat.id,
+                                                                        reply_message.message_id)
+        if context.submission_id is not None:
+            return None
+        urls = self.get_reply_urls(context)
+        if not urls:
+            return "Per usare questo comando devi rispondere ad un messaggio del bot contenente un link"
+        try:
+            context.submission_id = models.Submission.id_from_url(urls[-1])
+        except exceptions.ClientException:
+            return "Il link a cui hai risposto non è un link di reddit valido"
+        return None
+
+    @staticmethod
+    def check_has_title(context):
+        """
+        Precondition: the command arguments contain a title long enough
+        :param context: The CommandContext of the update
+        :return: None if the check passed, the error message otherwise
+        """
+        if len(context.args_markdown) < 1:
+            return "Utilizzando il comando, aggiungi un titolo al post:\n/" + context.command.name + " <titolo>"
+        elif len(context.args_markdown) < 6:
+            return "Serve un titolo più lungo! Riprova"
+        return None
+
+    def check_has_rule(self, context):
+        """
+        Precondition: the first command argument is a valid rule number, optionally followed by the posts
+        to delete (reddit links, or "u/<user> <time window>") and by a note.
+        The parsed values are saved in context.rule_text, context.link_ids, context.target_user,
+        context.target_window (seconds) and context.note_message
+        :param context: The CommandContext of the update
+        :return: None if the check passed, the error message otherwise
+        """
+        splitted_args = context.args_text.split()
+        if len(splitted_args) == 0:
+            return "Non hai fornito il numero di regola per rimuovere il post..."
+        try:
+            rule_number = int(splitted_args[0])
+        except ValueError:
+            return "Hai fornito un numero di regola non valido... " \
+                   "Utilizza il comando con /delrule <numero regola> <note(opzionale)>"
+        if rule_number not in self.rules:
+            return "Hai fornito un numero di regola non presente nella lista..."
+        context.rule_text = self.rules[rule_number]
+        # Read the posts to delete, they come before the note
+        context.link_ids = []
+        context.target_user = None
+        context.target_window = None
+        index = 1
+        while index < len(splitted_args):
+            user_match = self.user_target_regex.match(splitted_args[index])
+            if user_match is not None:
+                window_match = None
+                if index + 1 < len(splitted_args):
+                    window_match = self.time_window_regex.match(splitted_args[index + 1])
+                if window_match is None:
+                    return "Dopo l'utente devi indicare una finestra temporale, ad esempio: /delrule " + \
+                           str(rule_number) + " u/" + user_match.group(1) + " 2h"
+                context.target_user = user_match.group(1)
+                context.target_window = int(window_match.group(1)) * self.time_window_units[window_match.group(2)]
+                index += 2
+                continue
+            submission_id = self.get_reddit_submission_id(splitted_args[index])
+            if submission_id is None:
+                break
+            context.link_ids.append(submission_id)
+            index += 1
+        # The markdown text has the same words, only escaped
+        splitted_markdown = context.args_markdown.split(None, index)
+        context.note_message = splitted_markdown[index].strip() if len(splitted_markdown) > index else None
+        return None
+
+    def check_delrule_targets(self, context):
+        """
+        Precondition: /delrule has at least a post to delete, from the arguments or from the replied message.
+        The replied message is looked up in the message <-> submission map first, all its reddit links are used
+        otherwise. The post ids are saved in context.submission_ids, context.reply_is_target tells if the replied
+        message supplied any of them (only then it is deleted with the command)
+        :param context: The CommandContext of the update
+        :return: None if the check passed, the error message otherwise
+        """
+        submission_ids = list(context.link_ids)
+        context.reply_is_target = False
+        reply_message = context.message.reply_to_message
+        if reply_message:
+            mapped_id = self.state_store.get_message_submission(reply_message.chat.id, reply_message.message_id)
+            if mapped_id is not None:
+                submission_ids.append(mapped_id)
+                context.reply_is_target = True
+            else:
+                urls = self.get_reply_urls(context)
+                reply_ids = [self.get_reddit_submission_id(url) for url in urls]
+                reply_ids = [submission_id for submission_id in reply_ids if submission_id is not None]
+                if urls and not reply_ids and not submission_ids and context.target_user is None:
+                    return "Il link a cui hai risposto non è un link di reddit valido"
+                submission_ids += reply_ids
+                context.reply_is_target = bool(reply_ids)
+        # Remove the duplicates, keeping the order
+        context.submission_ids = list(dict.fromkeys(submission_ids))
+        if not context.submission_ids and context.target_user is None:
+            return "Per usare /delrule devi rispondere ad un messaggio contenente dei link a reddit, " \
+                   "oppure indicare i link o l'utente: /delrule <numero regola> [link...] " \
+                   "[u/<utente> <finestra, es. 2h>] <note(opzionale)>"
+        return None
+
+    def check_sender_admin(self, context):
+        """
+        Precondition: the command has been used from an administrator
+        :param context: The CommandContext of the update
+        :return: None if the check passed, the error message otherwise
+        """
+        if self.is_sender_admin(self.updater.bot, context.message.chat.id, context.message.from_user.id):
+            return None
+        return "Spiacente, non sei un amministratore."
+
+    def register_commands(self):
+        """
+        Register all the bot commands with the preconditions they require
+        """
+        authorized_group = Precondition("authorized_group", self.check_authorized_group)
+        is_reply = Precondition("is_reply", self.check_is_reply)
+        reply_has_single_url = Precondition("reply_has_single_url", self.check_reply_has_single_url,
+                                            requires=[is_reply])
+        reply_to_submission = Precondition("reply_to_submission", self.check_reply_to_submission, COST_STORE,
+                                           requires=[is_reply])
+        has_title = Precondition("has_title", self.check_has_title)
+        has_rule = Precondition("has_rule", self.check_has_rule)
+        delrule_targets = Precondition("delrule_targets", self.check_delrule_targets, COST_STORE,
+                                       requires=[has_rule])
+        sender_admin = Precondition("sender_admin", self.check_sender_admin, COST_NETWORK)
+
+        self.router.register("start", self.start)
+        self.router.register("comment", self.comment, [authorized_group, is_reply, reply_to_submission])
+        self.router.register("postlink", self.postlink, [authorized_group, is_reply, sender_admin,
+                                                         reply_has_single_url])
+        self.router.register("posttext", self.posttext, [authorized_group, is_reply, sender_admin, has_title])
+        self.router.register("delrule", self.delrule, [authorized_group, sender_admin, has_rule, delrule_targets])
+        # The preconditions run as the last middleware, right before the command
+        self.router.use(PreconditionMiddleware(self.reject_command))
+
     # ---------------------------------------------
     # Bot commands
     # ---------------------------------------------
 
-    def start(self, update):
+    def start(self, update, context):
         """ (Telegram command)
         Send a message when the command /start is issued.
         @:param update: an object that represents an incoming update.
+        @:param context: The CommandContext of the update
         """
         if update.message.chat.id != self.authorized_group_id:
             update.message.reply_text('Ciao, benvenuto in marvin! Visita la pagina '
@@ -256,329 +501,281 @@ class MarvinBot:
 
         return
 
-    def comment(self, update):
+    def comment(self, update, context):
         """ (Telegram command)
         Adds a comment to a reddit post (only if it belong to the authorized subreddit)
         :param update: an object that represents an incoming update.
+        :param context: The CommandContext of the update
         """
 
-        # Check if the command has been used in the correct group
-        if not self.is_message_in_correct_group(update.message.chat):
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Spiacente, questo bot funziona solo nel"
-                                                  "gruppo autorizzato con id " +
-                                                  str(self.authorized_group_id) + " (" + str(self.tg_group) + ")" +
-                                                  ", non in " +
-                                                  str(update.message.chat.id) + " (attuale)")
-            return
-        # Check if the command is used as reply to another message
-        if not update.message.reply_to_message:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Per usare /comment devi rispondere ad un messaggio")
-            return
-        # Check that the message has the url
-        urls_entities = update.message.reply_to_message.parse_entities([MessageEntity.URL])
-        if not urls_entities:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Per usare questo comando devi rispondere "
-                                                  "ad un messaggio del bot contenente un link")
-            return
         # Get the comment content, post id and post the comment
         comment_text = "\\[[Telegram](https://t.me/" + str(self.tg_group) + "/" + str(update.message.message_id) + "/)"
         username = self.get_user_name(update.message)
         comment_text += " - "
         comment_text += "[" + username + "](https://t.me/" + username[1:] + ")" + "\\]  \n"
-        comment_text += update.message.text_markdown.replace("/comment", "").strip()
-        url = urls_entities.popitem()[1]
-        try:
-            cutted_url = models.Submission.id_from_url(url)
-        except exceptions.ClientException:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Il link a cui hai risposto non è un link di reddit valido")
-            return
+        comment_text += context.args_markdown
+        cutted_url = context.submission_id
         submission = self.reddit.submission(id=cutted_url)
         if submission.subreddit.display_name == self.subreddit.display_name:
             if submission.locked:
-                self.delete_message_if_admin(update.message.chat, update.message.message_id)
-                self.send_tg_message_reply_or_private(update,
-                                                      "Non puoi commentare un post lockato!")
+                self.reject_command(update, "Non puoi commentare un post lockato!")
                 return
             else:
                 good_check = self.check_blacklist(comment_text)
                 if good_check is None:
                     created_comment = submission.reply(comment_text)
                     comment_link = "https://www.reddit.com" + created_comment.permalink
-                    self.updater.bot.send_message(self.authorized_group_id,
-                                                  "Commento aggiunto al post! (da: " + self.get_user_name(update.message)
-                                                  + ")\n" + comment_link,
-                                                  reply_to_message_id=update.message.reply_to_message.message_id)
+                    sent_message = self.updater.bot.send_message(
+                        self.authorized_group_id,
+                        "Commento aggiunto al post! (da: " + self.get_user_name(update.message) + ")\n" + comment_link,
+                        reply_to_message_id=update.message.reply_to_message.message_id)
+                    self.remember_submission_messages(cutted_url, sent_message)
                     self.logger.info("Comment added to post with id: " + str(cutted_url))
                     return
                 else:
-                    self.delete_message_if_admin(update.message.chat, update.message.message_id)
-                    self.send_tg_message_reply_or_private(update,
-                                                          "Il tuo commento contiene la seguente parola bandita: " +
-                                                          str(good_check)
-                                                          )
+                    self.reject_command(update, "Il tuo commento contiene la seguente parola bandita: " +
+                                        str(good_check))
                     return
         else:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Non puoi inviare commenti a post"
-                                                  "che non appartengono al subreddit: " +
-                                                  self.subreddit.display_name)
+            self.reject_command(update,
+                                "Non puoi inviare commenti a post"
+                                "che non appartengono al subreddit: " +
+                                self.subreddit.display_name)
             return
 
-    def postlink(self, subreddit, update):
+    def postlink(self, update, context):
         """ (Telegram command)
         Read the link and post it in the subreddit
-        :param subreddit: The subreddit where the bot should post the link
         :param update: an object that represents an incoming update.
+        :param context: The CommandContext of the update
         """
 
-        # Check if the command has been used in the correct group
-        if not self.is_message_in_correct_group(update.message.chat):
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Spiacente, questo bot funziona solo nel"
-                                                  "gruppo autorizzato con id " +
-                                                  str(self.authorized_group_id) + " (" + str(self.tg_group) + ")" +
-                                                  ", non in " +
-                                                  str(update.message.chat.id) + " (attuale)")
-            return
-        # Check if the command is used as reply to another message
-        if not update.message.reply_to_message:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Per usare /postlink devi rispondere ad un messaggio")
-            return
-        # Check if the command has been used from an administrator
-        if not self.is_sender_admin(self.updater.bot, update.message.chat.id, update.message.from_user.id):
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Spiacente, non sei un amministratore.")
-            return
         reply_message = update.message.reply_to_message
-
-        urls_entities = reply_message.parse_entities([MessageEntity.URL])
-        if not urls_entities:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Il messaggio originale deve contenere una URL")
-            return
-        if len(urls_entities) > 1:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Il messaggio originale deve contenere una **sola** URL")
-            return
-
-        link_to_post = urls_entities.popitem()[1]
+        link_to_post = self.get_reply_urls(context)[0]
         # Check link schema
         link_parsed = urlparse.urlparse(link_to_post)
         if not link_parsed.scheme:
             link_to_post = 'https://' + link_to_post
         elif link_parsed.scheme not in ['http', 'https']:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Il messaggio originale deve contenere un link HTTP(S)")
+            self.reject_command(update, "Il messaggio originale deve contenere un link HTTP(S)")
             return
         # Fetch page title
         link_page_title = self.get_page_title_from_url(link_to_post)
         if not link_page_title:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Non sono riuscito a trovare il titolo della pagina")
+            self.reject_command(update, "Non sono riuscito a trovare il titolo della pagina")
             return
         # Submit to reddit, add the default comment and send the link to Telegram:
         title = "[" + self.title_prefix + self.get_user_name(reply_message) + "] " + link_page_title
-        submission = subreddit.submit(title, url=link_to_post)
+        submission = self.subreddit.submit(title, url=link_to_post)
         self.add_default_comment(submission, update.message.reply_to_message.message_id)
-        self.updater.bot.send_message(self.authorized_group_id,
-                                      "Post creato: " + str(submission.shortlink) +
-                                      " (da: " + self.get_user_name(update.message) + ")",
-                                      reply_to_message_id=update.message.reply_to_message.message_id)
+        sent_message = self.updater.bot.send_message(self.authorized_group_id,
+                                                     "Post creato: " + str(submission.shortlink) +
+                                                     " (da: " + self.get_user_name(update.message) + ")",
+                                                     reply_to_message_id=update.message.reply_to_message.message_id)
+        self.remember_submission_messages(submission.id, reply_message, sent_message)
         self.logger.info("New link-post submitted")
 
-    def posttext(self, subreddit, update):
+    def posttext(self, update, context):
         """ (Telegram command)
         Given a text and a title (from an admin) it create a text post in the subreddit
-        :param subreddit: The subreddit where the bot should post the content
         :param update: an object that represents an incoming update.
+        :param context: The CommandContext of the update
         """
 
-        # Check if the command has been used in the correct group
-        if not self.is_message_in_correct_group(update.message.chat):
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Spiacente, questo bot funziona solo nel"
-                                                  "gruppo autorizzato con id " +
-                                                  str(self.authorized_group_id) + " (" + str(self.tg_group) + ")" +
-                                                  ", non in " +
-                                                  str(update.message.chat.id) + " (attuale)")
-            return
-        # Check if the command is used as reply to another message
-        if not update.message.reply_to_message:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Per usare /posttext devi rispondere ad un messaggio")
-            return
-        # Check if the command has been used from an administrator
-        if not self.is_sender_admin(self.updater.bot, update.message.chat.id, update.message.from_user.id):
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Spiacente, non sei un amministratore.")
-            return
-
         reply_message = update.message.reply_to_message
 
-        question_title = "[" + self.title_prefix + self.get_user_name(reply_message) + "] "
-        admin_post_title = update.message.text_markdown.replace("/posttext", "").strip()
-        if len(admin_post_title) < 1:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Utilizzando il comando, aggiungi "
-                                                  "un titolo al post:\n/posttext <titolo>")
-            return
-        elif len(admin_post_title) < 6:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Serve un titolo più lungo! Riprova")
-            return
-        else:
-            question_title += admin_post_title
-
+        question_title = "[" + self.title_prefix + self.get_user_name(reply_message) + "] " + context.args_markdown
         question_content = reply_message.text_markdown
 
         # Submit to reddit, add the default comment and send the link to Telegram:
-        submission = subreddit.submit(question_title, selftext=question_content)
+        submission = self.subreddit.submit(question_title, selftext=question_content)
         self.add_default_comment(submission, update.message.reply_to_message.message_id)
-        self.updater.bot.send_message(self.authorized_group_id,
-                                      "Post creato: " + str(submission.shortlink) +
-                                      " (da: " + self.get_user_name(update.message) + ")",
-                                      reply_to_message_id=update.message.reply_to_message.message_id)
+        sent_message = self.updater.bot.send_message(self.authorized_group_id,
+                                                     "Post creato: " + str(submission.shortlink) +
+                                                     " (da: " + self.get_user_name(update.message) + ")",
+                                                     reply_to_message_id=update.message.reply_to_message.message_id)
+        self.remember_submission_messages(submission.id, reply_message, sent_message)
         self.logger.info("New text-post submitted")
 
-    def delrule(self, update):
+    def delrule(self, update, context):
         """ (Telegram command)
-        Delete a post from the subreddit, posting the reason as comment reading it from the rule dictionary
+        Delete one or more posts from the subreddit, posting the reason as comment reading it from the rule dictionary.
+        A single post is deleted immediately, more posts are deleted through the moderation queue
         :param update: update: an object that represents an incoming update.
+        :param context: The CommandContext of the update
         """
 
-        # Check if the command has been used in the correct group
-        if not self.is_message_in_correct_group(update.message.chat):
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Spiacente, questo bot funziona solo nel"
-                                                  "gruppo autorizzato con id " +
-                                                  str(self.authorized_group_id) + " (" + str(self.tg_group) + ")" +
-                                                  ", non in " +
-                                                  str(update.message.chat.id) + " (attuale)")
-            return
-        # Check if the command is used as reply to another message
-        if not update.message.reply_to_message:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Per usare /delrule devi rispondere ad un messaggio")
-            return
-        # Check if the command has been used from an administrator
-        if not self.is_sender_admin(self.updater.bot, update.message.chat.id, update.message.from_user.id):
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Spiacente, non sei un amministratore.")
-            return
-        # Check that the message has the url
-        urls_entities = update.message.reply_to_message.parse_entities([MessageEntity.URL])
-        if not urls_entities:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Per usare questo comando devi rispondere "
-                                                  "ad un messaggio del bot contenente un link")
-            return
-        # Get the rule content, post the comment and delete the post
-        url = urls_entities.popitem()[1]
-        try:
-            cutted_url = models.Submission.id_from_url(url)
-        except exceptions.ClientException:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Il link a cui hai risposto non è un link di reddit valido")
-            return
-        splitted_message = update.message.text_markdown.replace("/delrule", "").strip().split()
-        note_message = None
-        rule_text = None
-        rule_number = -1
-        # Read the rule number
-        if len(splitted_message) == 0:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Non hai fornito il numero di regola per rimuovere il post...")
-            return
-        elif len(splitted_message) >= 1:
+        # Resolve all the requested posts with batched /api/info requests (100 posts per request)
+        submissions = []
+        if context.submission_ids:
+            submissions = list(self.reddit.info(["t3_" + submission_id for submission_id in context.submission_ids]))
+        if context.target_user is not None:
             try:
-                rule_number = int(splitted_message[0])
-            except ValueError:
-                self.delete_message_if_admin(update.message.chat, update.message.message_id)
-                self.send_tg_message_reply_or_private(update,
-                                                      "Hai fornito un numero di regola non valido... "
-                                                      "Utilizza il comando con /delrule "
-                                                      "<numero regola> <note(opzionale)>")
+                submissions += self.get_user_submissions(context.target_user, context.target_window)
+            except (NotFound, Forbidden):
+                # Suspended and shadowbanned accounts can't be listed
+                self.reject_command(update, "Utente u/" + context.target_user + " non trovato o sospeso")
                 return
-            if rule_number not in self.rules:
-                self.delete_message_if_admin(update.message.chat, update.message.message_id)
-                self.send_tg_message_reply_or_private(update,
-                                                      "Hai fornito un numero di regola non presente nella lista...")
+        targets = []
+        target_ids = set()
+        for submission in submissions:
+            if submission.subreddit.display_name == self.subreddit.display_name and submission.id not in target_ids:
+                targets.append(submission)
+                target_ids.add(submission.id)
+        delete_comment = self.build_delete_comment(context.rule_text, context.note_message)
+
+        if context.target_user is None and len(context.submission_ids) == 1:
+            if not submissions:
+                self.reject_command(update, "Non ho trovato il post da cancellare")
+                return
+            if not targets:
+                self.reject_command(update, "Non puoi cancellare post che non appartengono al subreddit: " +
+                                    self.subreddit.display_name)
                 return
-            rule_text = self.rules[rule_number]
-        # Read the note message if present
-        if len(splitted_message) > 1:
-            note_message = update.message.text_markdown.replace("/delrule", "").replace(str(rule_number), "").strip()
-        submission = self.reddit.submission(id=cutted_url)
-        if submission.subreddit.display_name == self.subreddit.display_name:
-            # Create delete comment
-            delete_comment = "Il tuo post è stato rimosso per la violazione del seguente articolo del regolamento:\n\n"
-            delete_comment += "* " + rule_text + "\n\n"
-            if note_message is not None:
-                delete_comment += note_message + "\n\n"
-            delete_comment += "Se hai dubbi o domande, ti preghiamo di inviare un messaggio in "
-            delete_comment += "[modmail](https://www.reddit.com/message/compose?to=%2Fr%2F" \
-                              + self.subreddit.display_name + ").\n\n"
-
             # Send the comment, remove and lock the post
-            comment = submission.reply(delete_comment)
-            comment.mod.distinguish(sticky=True)
-            mod_object = submission.mod
-            mod_object.remove()
-            mod_object.lock()
-            self.delete_message_if_admin(update.message.chat, update.message.reply_to_message.message_id)
+            self.remove_submission(targets[0], delete_comment)
+            # The replied message is deleted only if it pointed to the deleted post
+            if context.reply_is_target:
+                self.delete_message_if_admin(update.message.chat, update.message.reply_to_message.message_id)
             self.delete_message_if_admin(update.message.chat, update.message.message_id)
             self.updater.bot.send_message(self.authorized_group_id,
                                           "Il post è stato cancellato! (da: "
-<<<<<<< HEAD
-                                          + self.get_user_name(update.message) + ")",
-                                          reply_to_message_id=update.message.reply_to_message.message_id)
-            self.logger.info("Post with id: " + str(cutted_url) + " has been deleted from Telegram")
-=======
                                           + self.get_user_name(update.message) + ")")
-            self.logger.info("Post with id:" + str(cutted_url) + " has been deleted from Telegram")
->>>>>>> master
-        else:
-            self.delete_message_if_admin(update.message.chat, update.message.message_id)
-            self.send_tg_message_reply_or_private(update,
-                                                  "Non puoi cancellare post che non appartengono al subreddit: " +
-                                                  self.subreddit.display_name)
+            self.logger.info("Post with id: " + str(targets[0].id) + " has been deleted from Telegram")
+            return
 
+        if not targets:
+            self.reject_command(update, "Non ho trovato post da cancellare nel subreddit: " +
+                                self.subreddit.display_name)
             return
 
+        # Bulk mode: queue the removals and report the progress editing a single message
+        skipped = len([submission_id for submission_id in context.submission_ids if submission_id not in target_ids])
+        user_name = self.get_user_name(update.message)
+        if context.reply_is_target:
+            self.delete_message_if_admin(update.message.chat, update.message.reply_to_message.message_id)
+        self.delete_message_if_admin(update.message.chat, update.message.message_id)
+        progress_message = self.updater.bot.send_message(self.authorized_group_id,
+                                                         "Rimozione di " + str(len(targets)) +
+                                                         " post in corso... (da: " + user_name + ")")
+        tracker = ProgressTracker(len(targets), partial(self.report_bulk_delete_progress, progress_message,
+                                                        len(targets), skipped, user_name))
+        for submission in targets:
+            self.moderation_queue.submit(partial(self.bulk_delete_job, update.message.chat, submission.id,
+                                                 delete_comment),
+                                         tracker.job_done)
+        self.logger.info("Queued the deletion of " + str(len(targets)) + " posts")
+
+    def build_delete_comment(self, rule_text, note_message):
+        """
+        Function that return the comment explaining why a post has been removed
+        :param rule_text: The text of the violated rule
+        :param note_message: Optional note from the moderator, None if not present
+        :return: The comment text
+        """
+        delete_comment = "Il tuo post è stato rimosso per la violazione del seguente articolo del regolamento:\n\n"
+        delete_comment += "* " + rule_text + "\n\n"
+        if note_message is not None:
+            delete_comment += note_message + "\n\n"
+        delete_comment += "Se hai dubbi o domande, ti preghiamo di inviare un messaggio in "
+        delete_comment += "[modmail](https://www.reddit.com/message/compose?to=%2Fr%2F" \
+                          + self.subreddit.display_name + ").\n\n"
+        return delete_comment
+
+    @staticmethod
+    def remove_submission(submission, delete_comment):
+        """
+        Post the removal reason as sticky comment, then remove and lock the post
+        :param submission: The post to remove
+        :param delete_comment: The comment explaining why the post has been removed
+        """
+        comment = submission.reply(delete_comment)
+        comment.mod.distinguish(sticky=True)
+        mod_object = submission.mod
+        mod_object.remove()
+        mod_object.lock()
+
+    def get_user_submissions(self, username, window):
+        """
+        Function that return the posts submitted in the subreddit by the given user
+        :param username: The reddit username
+        :param window: How many seconds back to look for posts
+        :return: The list of posts, newest first
+        """
+        cutoff = time.time() - window
+        submissions = []
+        for submission in self.reddit.redditor(username).submissions.new(limit=100):
+            # The listing is sorted from the newest post
+            if submission.created_utc < cutoff:
+                break
+            if submission.subreddit.display_name == self.subreddit.display_name:
+                submissions.append(submission)
+        return submissions
+
+    def bulk_delete_job(self, tg_group, submission_id, delete_comment, reddit):
+        """
+        Moderation job: remove the post and delete the bot messages that refer to it in the authorized group
+        :param tg_group: The authorized group
+        :param submission_id: The id of the post to remove
+        :param delete_comment: The comment explaining why the post has been removed
+        :param reddit: The reddit instance of the worker running the job
+        """
+        self.remove_submission(reddit.submission(id=submission_id), delete_comment)
+        for chat_id, message_id in self.state_store.get_submission_messages(submission_id):
+            if chat_id == tg_group.id:
+                try:
+                    self.delete_message_if_admin(tg_group, message_id)
+                except TelegramError:
+                    # Already deleted or too old to be deleted
+                    pass
+        self.logger.info("Post with id: " + str(submission_id) + " has been deleted from Telegram")
+
+    def report_bulk_delete_progress(self, progress_message, total, skipped, user_name, done, failed, finished):
+        """
+        Show the progress of a bulk delete editing the progress message
+        :param progress_message: The message to edit
+        :param total: Number of posts to delete
+        :param skipped: Number of requested posts not found or not in the subreddit
+        :param user_name: The moderator that used the command
+        :param done: Number of completed jobs
+        :param failed: Number of failed jobs
+        :param finished: True if all the jobs are completed
+        """
+        if finished:
+            text = "Rimozione completata: " + str(done - failed) + "/" + str(total) + \
+                   " post cancellati (da: " + user_name + ")"
+        else:
+            text = "Rimozione in corso: " + str(done) + "/" + str(total) + " post... (da: " + user_name + ")"
+        if failed > 0:
+            text += "\nErrori: " + str(failed)
+        if skipped > 0:
+            text += "\nPost ignorati (non trovati o di altri subreddit): " + str(skipped)
+        try:
+            self.updater.bot.edit_message_text(text, chat_id=progress_message.chat_id,
+                                               message_id=progress_message.message_id)
+        except TelegramError as e:
+            self.logger.warning("Unable to update the bulk delete progress!", exc_info=e)
+
+    def remember_submission_messages(self, submission_id, *messages):
+        """
+        Save that the given Telegram messages refer to the given reddit post,
+        so commands used in reply to them don't need to parse the post url
+        :param submission_id: The id of the reddit post
+        :param messages: The Telegram messages that refer to the post
+        """
+        for message in messages:
+            if message is not None:
+                self.state_store.add_message_submission(message.chat_id, message.message_id, submission_id)
+
     def pin_if_necessary(self, to_pin, submission):
         """ (Telegram command)
         Pin reddit post if necessary
         :param to_pin: the message to pin
         :param submission: the reddit post
         """
+        # Posts of deleted accounts have no author
+        if submission.author is None:
+            return
         for autopin_rule in self.auto_pinned_posts:
             if submission.title.lower().find(autopin_rule["text"]) != -1:
                 for authors_pin in autopin_rule["users"]:
@@ -594,21 +791,85 @@ class MarvinBot:
     def check_new_reddit_posts(self):
         """
         This function listen for new post being submitted in the connected subreddit
-        When a new post appear, it send a Telegram message in the authorized group
+        When a new post appear, it send a Telegram message in the authorized group.
+        It runs while this replica is the leader, then it stops the bot so a standby replica can take over
         """
         bot_ref = self.updater.bot
         self.logger.info("check_new_reddit_posts thread started")
-        for submission in self.subreddit.stream.submissions(skip_existing=True):
-            notification_content = submission.title + "\n" + \
-                                   "Postato da: " + submission.author.name + "\n" + \
-                                   submission.shortlink
+        while self.leader.is_leader:
+            try:
+                self.consume_reddit_stream(bot_ref)
+            except Exception as e:
+                # Fetch and network failures (a single post failure is handled by consume_reddit_stream).
+                # The lease is still renewed by its own thread, so the stream must be restarted, not left dead
+                self.logger.warning("Subreddit stream failed, restarting it in " + str(self.stream_retry_delay) +
+                                    " seconds...", exc_info=e)
+                set_correlation_id(None)
+                sleep(self.stream_retry_delay)
+        # The lease has been lost: stop polling Telegram too, the new leader is taking over
+        self.logger.warning("This replica is no longer the leader, stopping the bot...")
+        self.updater.is_idle = False
+
+    def consume_reddit_stream(self, bot_ref):
+        """
+        Send the notifications for the new posts until this replica is no longer the leader
+        :param bot_ref: The current bot instance
+        """
+        self.logger.info("Consuming the subreddit stream as leader")
+        # Resume from the last notified post, so posts submitted while no leader was running are not lost
+        last_id = self.state_store.get_checkpoint("submissions")
+        # pause_after=0 yields None, without sleeping, after every fetch without new posts:
+        # wait here instead, so the leadership is checked between fetches without flooding reddit
+        for submission in self.subreddit.stream.submissions(skip_existing=last_id is None, pause_after=0):
+            if not self.leader.is_leader:
+                return
+            if submission is None:
+                sleep(self.stream_poll_interval)
+                continue
+            # Reddit ids are base36 and always increasing
+            if last_id is not None and int(submission.id, 36) <= int(last_id, 36):
+                continue
+            set_correlation_id("reddit-" + submission.id)
+            started = perf_counter()
+            try:
+                self.notify_submission(bot_ref, submission)
+                self.logger.info("Notification sent for post with id: " + submission.id,
+                                 extra={"submission_id": submission.id,
+                                        "duration_ms": round((perf_counter() - started) * 1000, 2)})
+            except Exception as e:
+                # Skip the post: retrying it would block the stream, or send the same notification again
+                self.logger.warning("Unable to notify the post with id: " + submission.id + ", skipping it",
+                                    exc_info=e, extra={"submission_id": submission.id})
+            last_id = submission.id
+            self.state_store.set_checkpoint("submissions", last_id)
+            # Write it now, a replica taking over must not notify this post again
+            self.state_store.flush()
+            set_correlation_id(None)
+
+    def notify_submission(self, bot_ref, submission):
+        """
+        Send the notifications for a new post, pinning it if necessary
+        :param bot_ref: The current bot instance
+        :param submission: The new reddit post
+        """
+        # Posts of deleted accounts have no author
+        author_name = submission.author.name if submission.author is not None else "[deleted]"
+        notification_content = submission.title + "\n" + \
+                               "Postato da: " + author_name + "\n" + \
+                               submission.shortlink
+        admin_notification = None
+        to_pin = None
+        try:
             # Send admin notification
             if self.admin_group_id != 0:
-                bot_ref.send_message(self.admin_group_id, notification_content)
+                admin_notification = bot_ref.send_message(self.admin_group_id, notification_content)
             # Send notification to everyone in the authorized group
             if submission.author != self.reddit.user.me().name:
                 to_pin = bot_ref.send_message(self.authorized_group_id, submission.title + "\n" + submission.shortlink)
                 self.pin_if_necessary(to_pin, submission)
+        finally:
+            # Remember the notifications already sent, even if a later step failed
+            self.remember_submission_messages(submission.id, admin_notification, to_pin)
 
     # ---------------------------------------------
     # Bot Start and Error manager
@@ -623,32 +884,58 @@ class MarvinBot:
         """
         self.logger.warning('\nUpdate status:\n"%s"\nCaused error:\n"%s"', update, error)
 
+    def unknown_command(self, update):
+        """
+        Delete, after a few seconds, the commands not handled by the bot
+        :param update: an object that represents an incoming update.
+        """
+        self.delete_message_if_admin(update.message.chat, update.message.message_id, 5)
+
+    def log_command_duration(self, context, next_handler):
+        """
+        Command middleware that logs how long every command took
+        :param context: The CommandContext of the update
+        :param next_handler: The next handler of the chain
+        """
+        command_name = context.command.name if context.command is not None else "unknown"
+        started = perf_counter()
+        try:
+            next_handler(context)
+        finally:
+            duration_ms = round((perf_counter() - started) * 1000, 2)
+            self.logger.info("Command /" + command_name + " handled in " + str(duration_ms) + " ms",
+                             extra={"command": command_name, "duration_ms": duration_ms})
+
     def message_handler(self, bot, update):
-        if update.message.text is not None and update.message.text.startswith("/"):
-            if update.message.text.startswith("/start"):
-                self.start(update)
-            elif update.message.text.startswith("/comment"):
-                self.comment(update)
-            elif update.message.text.startswith("/postlink"):
-                self.postlink(self.subreddit, update)
-            elif update.message.text.startswith("/posttext"):
-                self.posttext(self.subreddit, update)
-            elif update.message.text.startswith("/delrule"):
-                self.delrule(update)
-            else:
-                self.delete_message_if_admin(update.message.chat, update.message.message_id, 5)
+        # Every log line written while handling the update carries its id
+        set_correlation_id("tg-" + str(update.update_id))
+        try:
+            if update.message is not None:
+                self.router.dispatch(update)
+        finally:
+            set_correlation_id(None)
         return
 
-    def main(self):
-        """Start the bot."""
-        self.logger.info("Starting bot... Reading login Token...")
-
-        # Read the token from the json
-        bot_data_file = None
+    @classmethod
+    def read_bot_data(cls):
+        """
+        Read the bot configuration file
+        :return: The parsed JSON, None if the file has not been found
+        """
         try:
-            with open(self.config_file_name) as data_file:
-                bot_data_file = json.load(data_file)
+            with open(cls.config_file_name) as data_file:
+                return json.load(data_file)
         except FileNotFoundError:
+            return None
+
+    def main(self, bot_data_file):
+        """Start the bot.
+        :param bot_data_file: The bot configuration, as returned by read_bot_data
+        """
+        self.logger.info("Starting bot... Reading login Token...")
+
+        # Check the token json has been read
+        if bot_data_file is None:
             self.logger.error("FATAL ERROR-->" + self.config_file_name + " FILE NOT FOUND, ABORTING...")
             quit(1)
         self.logger.info("Starting bot... Reading informations from files...")
@@ -691,15 +978,20 @@ class MarvinBot:
             self.logger.error("FATAL ERROR-->" + self.auto_pinned_posts_file_name + " FILE NOT FOUND, ABORTING...")
             quit(1)
 
+        # Open the state database
+        self.state_store = StateStore(self.state_database_file_name, self.logger)
+
         # Setup requests session:
         self.session = requests.Session()
 
-        # Load cached cookies
-        try:
-            with open(self.cookie_cache_file_name, "rb") as f:
-                self.session.cookies.update(pickle.load(f))
-        except FileNotFoundError:
-            self.logger.info("Unable to load cached cookies, creating new ones automatically.")
+        # Load cached cookies, importing the old pickled cache if the database has none
+        if self.state_store.load_cookies(self.session.cookies) == 0:
+            try:
+                with open(self.cookie_cache_file_name, "rb") as f:
+                    self.session.cookies.update(pickle.load(f))
+                self.state_store.save_cookies(self.session.cookies)
+            except FileNotFoundError:
+                self.logger.info("Unable to load cached cookies, creating new ones automatically.")
 
         # Set custom UserAgent:
         self.session.headers[
@@ -726,40 +1018,66 @@ class MarvinBot:
         # Get the dispatcher to register handlers
         dp = self.updater.dispatcher
 
-        # Register commands
+        # Register commands, the duration is logged for rejected commands too
+        self.router.use(self.log_command_duration)
+        self.register_commands()
+        moderation_data = bot_data_file.get("moderation", {})
+        self.moderation_queue = ModerationQueue(self.logger, partial(Reddit, **bot_data_file["reddit"]),
+                                                workers=moderation_data.get("workers", 4),
+                                                jobs_per_second=moderation_data.get("posts_per_second", 0.5))
+        self.router.bot_username = self.updater.bot.username
         dp.add_handler(MessageHandler(filters=None, callback=self.message_handler))
 
         # log all errors
         dp.add_error_handler(self.error_handler)
 
+        # Start the leader election. Only the leader polls Telegram and runs the reddit stream:
+        # Telegram rejects concurrent getUpdates on the same token (409 Conflict), so the other replicas are standbys
+        leader_election_data = bot_data_file.get("leader_election", {})
+        self.leader = LeaderElector(self.state_database_file_name, self.logger,
+                                    lease_seconds=leader_election_data.get("lease_seconds", 15),
+                                    renew_interval=leader_election_data.get("renew_interval"))
+        self.leader.start()
+        self.logger.info("Starting bot... Waiting to become the leader replica...")
+        while not self.leader.wait_for_leadership(1):
+            pass
+
         self.logger.info("Starting bot... Starting polling and threads...")
 
         # Start the Bot and the important threads
         self.updater.start_polling()
 
-        new_reddit_posts_thread = Thread(target=self.check_new_reddit_posts, args=[])
+        new_reddit_posts_thread = Thread(target=self.check_new_reddit_posts, args=[], daemon=True)
         new_reddit_posts_thread.start()
 
         self.logger.info("Bot successfully loaded...! Bot ready!")
 
+        # Returns on SIGINT/SIGTERM, or when the lease is lost
         self.updater.idle()
+        self.updater.stop()
+
+        # Release the lease, so another replica takes over immediately, and write the pending state before exiting
+        self.leader.stop()
+        self.moderation_queue.shutdown()
+        self.state_store.close()
 
 
 if __name__ == '__main__':
-    # Enable logging creating logger and file handler
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    # Read the configuration once, the logging settings are needed before the bot starts
+    bot_data = MarvinBot.read_bot_data()
+    logging_data = bot_data.get("logging", {}) if bot_data is not None else {}
+
+    # Enable logging: records are queued and written to the console and to the rotating file by a background thread
+    log_listener = setup_logging("logs",
+                                 json_format=logging_data.get("json", False),
+                                 max_bytes=logging_data.get("max_bytes", 10 * 1024 * 1024),
+                                 backup_count=logging_data.get("backup_count", 10),
+                                 when=logging_data.get("when"))
     logger = logging.getLogger(__name__)
 
-    now = datetime.datetime.now()
-    filename = str(now.year) + "-" + str(now.month) + "-" + str(now.day) + "-" + str(now.hour) + "-" + str(
-        now.minute) + "-" + str(now.second)
-
-    fh = logging.FileHandler('logs/' + filename + '.log')
-    fh.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fh.setFormatter(formatter)
-    logger.addHandler(fh)
-
     # Create and start the bot class
-    MarvinBot(logger).main()
+    try:
+        MarvinBot(logger).main(bot_data)
+    finally:
+        # Write the queued records before exiting
+        log_listener.stop()
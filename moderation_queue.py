@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, local
+from log_pipeline import get_correlation_id, set_correlation_id
+
+
+class RateLimiter:
+    """
+    Token bucket shared between the moderation workers
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: Number of operations allowed per second
+        :param burst: Number of operations that can start together after an idle period
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        """
+        Block until an operation is allowed
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # The token is reserved even when it is not available yet, so the waiting threads are queued in order
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ModerationQueue:
+    """
+    Run the moderation jobs concurrently on a fixed number of workers, limiting the rate they start at.
+    PRAW instances can't be shared between threads, so every worker gets its own reddit instance
+    """
+
+    def __init__(self, logger_ref, reddit_factory, workers=4, jobs_per_second=0.5):
+        """
+        :param logger_ref: The logger to use
+        :param reddit_factory: Callable without arguments that creates a new praw Reddit instance
+        :param workers: Number of jobs running at the same time
+        :param jobs_per_second: Max number of jobs started per second
+        """
+        self.logger = logger_ref
+        self.reddit_factory = reddit_factory
+        self.limiter = RateLimiter(jobs_per_second, burst=workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="moderation")
+        self._worker_data = local()
+        self._futures = set()
+        self._futures_lock = Lock()
+        self._stop_event = Event()
+
+    def _get_reddit(self):
+        """
+        :return: The reddit instance of the current worker, created on first use
+        """
+        reddit = getattr(self._worker_data, "reddit", None)
+        if reddit is None:
+            reddit = self.reddit_factory()
+            self._worker_data.reddit = reddit
+        return reddit
+
+    def submit(self, job, on_done):
+        """
+        Queue a job
+        :param job: Callable that receives the reddit instance of the worker running it
+        :param on_done: Callable (error) called when the job ends, error is None if the job succeeded
+        """
+        # The log lines written by the job keep the correlation id of the update that queued it
+        correlation_id = get_correlation_id()
+
+        def run():
+            set_correlation_id(correlation_id)
+            try:
+                self.limiter.acquire()
+                if self._stop_event.is_set():
+                    return
+                error = None
+                try:
+                    job(self._get_reddit())
+                except Exception as e:
+                    self.logger.warning("Moderation job failed!", exc_info=e)
+                    error = e
+                on_done(error)
+            finally:
+                # The worker thread is reused by jobs queued from other updates
+                set_correlation_id(None)
+
+        future = self._executor.submit(run)
+        with self._futures_lock:
+            self._futures.add(future)
+        future.add_done_callback(self._forget_future)
+
+    def _forget_future(self, future):
+        """
+        Remove a completed (or cancelled) job from the pending ones
+        :param future: The job future
+        """
+        with self._futures_lock:
+            self._futures.discard(future)
+
+    def shutdown(self):
+        """
+        Cancel the queued jobs, wait only for the running ones and stop the workers.
+        The cancelled jobs are logged, their progress is not reported since the bot is stopping
+        """
+        self._stop_event.set()
+        with self._futures_lock:
+            futures = list(self._futures)
+        cancelled = len([future for future in futures if future.cancel()])
+        if cancelled > 0:
+            self.logger.warning("Shutdown: " + str(cancelled) + " queued moderation jobs cancelled")
+        self._executor.shutdown(wait=True)
+
+
+class ProgressTracker:
+    """
+    Count the completed jobs of a batch, reporting the progress at most every min_interval seconds
+    """
+
+    def __init__(self, total, report, min_interval=2.0):
+        """
+        :param total: Number of jobs in the batch
+        :param report: Callable (done, failed, finished) used to show the progress
+        :param min_interval: Min seconds between two intermediate reports, the final one is always sent
+        """
+        self.total = total
+        self.report = report
+        self.min_interval = min_interval
+        self.done = 0
+        self.failed = 0
+        self._last_report = time.monotonic()
+        self._lock = Lock()
+
+    def job_done(self, error):
+        """
+        Record the end of a job
+        :param error: None if the job succeeded, the exception otherwise
+        """
+        with self._lock:
+            self.done += 1
+            if error is not None:
+                self.failed += 1
+            finished = self.done == self.total
+            now = time.monotonic()
+            if not finished and now - self._last_report < self.min_interval:
+                return
+            self._last_report = now
+            # Reported while holding the lock, so an intermediate report can't overwrite the final one
+            self.report(self.done, self.failed, finished)
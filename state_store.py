@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+import sqlite3
+import time
+
+from threading import Event, RLock, Thread
+
+
+# Statements are kept as module constants so that sqlite3's statement cache can reuse the prepared version
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cookies (
+    name TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    path TEXT NOT NULL,
+    value TEXT,
+    expires INTEGER,
+    secure INTEGER NOT NULL,
+    PRIMARY KEY (name, domain, path)
+);
+CREATE TABLE IF NOT EXISTS chat_permissions (
+    chat_id INTEGER PRIMARY KEY,
+    is_admin INTEGER NOT NULL,
+    checked_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stream_checkpoints (
+    stream TEXT PRIMARY KEY,
+    last_id TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS title_cache (
+    url TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS message_submissions (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    submission_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS message_submissions_by_submission ON message_submissions (submission_id);
+"""
+
+SQL_DELETE_COOKIES = "DELETE FROM cookies"
+SQL_INSERT_COOKIE = "INSERT OR REPLACE INTO cookies (name, domain, path, value, expires, secure) " \
+                    "VALUES (?, ?, ?, ?, ?, ?)"
+SQL_SELECT_COOKIES = "SELECT name, domain, path, value, expires, secure FROM cookies"
+
+SQL_UPSERT_CHAT_PERMISSION = "INSERT OR REPLACE INTO chat_permissions (chat_id, is_admin, checked_at) VALUES (?, ?, ?)"
+SQL_SELECT_CHAT_PERMISSION = "SELECT is_admin FROM chat_permissions WHERE chat_id = ? AND checked_at >= ?"
+
+SQL_UPSERT_CHECKPOINT = "INSERT OR REPLACE INTO stream_checkpoints (stream, last_id, updated_at) VALUES (?, ?, ?)"
+SQL_SELECT_CHECKPOINT = "SELECT last_id FROM stream_checkpoints WHERE stream = ?"
+
+SQL_UPSERT_TITLE = "INSERT OR REPLACE INTO title_cache (url, title, fetched_at) VALUES (?, ?, ?)"
+SQL_SELECT_TITLE = "SELECT title FROM title_cache WHERE url = ? AND fetched_at >= ?"
+SQL_PRUNE_TITLES = "DELETE FROM title_cache WHERE fetched_at < ?"
+
+SQL_UPSERT_MESSAGE_SUBMISSION = "INSERT OR REPLACE INTO message_submissions " \
+                                "(chat_id, message_id, submission_id, created_at) VALUES (?, ?, ?, ?)"
+SQL_SELECT_MESSAGE_SUBMISSION = "SELECT submission_id FROM message_submissions WHERE chat_id = ? AND message_id = ?"
+SQL_SELECT_SUBMISSION_MESSAGES = "SELECT chat_id, message_id FROM message_submissions WHERE submission_id = ?"
+SQL_PRUNE_MESSAGE_SUBMISSIONS = "DELETE FROM message_submissions WHERE created_at < ?"
+
+
+class StateStore:
+    """
+    Embedded SQLite (WAL mode) store used for all the bot runtime data:
+    cookies, chat permission cache, stream checkpoints, page title cache and
+    the Telegram message <-> Reddit submission map.
+    Writes are queued and flushed in a single transaction, point reads are answered from the queue when possible.
+    """
+
+    def __init__(self, database_file_name, logger_ref, flush_interval=2.0, batch_size=50,
+                 chat_permission_ttl=3600, title_ttl=86400, message_retention=30 * 86400):
+        """
+        :param database_file_name: Path of the SQLite database file
+        :param logger_ref: The logger to use
+        :param flush_interval: Max seconds a queued write waits before being flushed
+        :param batch_size: Number of queued writes that triggers an immediate flush
+        :param chat_permission_ttl: Seconds after which a cached chat permission is checked again
+        :param title_ttl: Seconds after which a cached page title is fetched again
+        :param message_retention: Seconds after which a message <-> submission mapping is forgotten
+        """
+        self.logger = logger_ref
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.chat_permission_ttl = chat_permission_ttl
+        self.title_ttl = title_ttl
+        self.message_retention = message_retention
+        # The connection is shared between the dispatcher and the stream threads, access is serialized by the lock
+        self._lock = RLock()
+        self._connection = sqlite3.connect(database_file_name, check_same_thread=False, cached_statements=64)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        # Queued writes as (sql, params) tuples, flushed in order
+        self._pending = []
+        # Last cookie jar to save, only the most recent one matters
+        self._pending_cookies = None
+        self._last_prune = 0
+        self._stop_event = Event()
+        self._flush_thread = Thread(target=self._flush_loop, name="state-store-flush", daemon=True)
+        self._flush_thread.start()
+
+    # ---------------------------------------------
+    # Write batching
+    # ---------------------------------------------
+
+    def _enqueue(self, sql, params):
+        """
+        Queue a write, flushing immediately if the batch is full
+        :param sql: One of the SQL_* statements
+        :param params: The statement parameters
+        """
+        with self._lock:
+            self._pending.append((sql, params))
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """
+        Write all the queued statements in a single transaction
+        """
+        with self._lock:
+            if not self._pending and self._pending_cookies is None:
+                return
+            pending = self._pending
+            cookies = self._pending_cookies
+            self._pending = []
+            self._pending_cookies = None
+            try:
+                with self._connection:
+                    # Group consecutive runs of the same statement so they are sent with a single executemany
+                    index = 0
+                    while index < len(pending):
+                        sql = pending[index][0]
+                        end = index
+                        while end < len(pending) and pending[end][0] == sql:
+                            end += 1
+                        self._connection.executemany(sql, [params for _, params in pending[index:end]])
+                        index = end
+                    if cookies is not None:
+                        self._connection.execute(SQL_DELETE_COOKIES)
+                        self._connection.executemany(SQL_INSERT_COOKIE, cookies)
+            except sqlite3.Error as e:
+                self.logger.warning("Unable to write the bot state!", exc_info=e)
+
+    def prune(self):
+        """
+        Delete expired title cache entries and old message mappings, so the database stays bounded
+        """
+        now = time.time()
+        self._enqueue(SQL_PRUNE_TITLES, (now - self.title_ttl,))
+        self._enqueue(SQL_PRUNE_MESSAGE_SUBMISSIONS, (now - self.message_retention,))
+        self.flush()
+        self._last_prune = now
+
+    def _flush_loop(self):
+        """
+        Background thread that flushes the queued writes and prunes old data periodically
+        """
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+            if time.time() - self._last_prune > 3600:
+                self.prune()
+
+    def _query_value(self, sql, params, write_sql, key, value_index):
+        """
+        Return a single value, reading it from the queued writes if present, from the database otherwise.
+        The queue is not flushed, so reads don't break the write batching
+        :param sql: One of the SQL_SELECT_* statements, selecting the value only
+        :param params: The select statement parameters
+        :param write_sql: The SQL_UPSERT_* statement that writes the value
+        :param key: The leading parameters of write_sql that identify the row
+        :param value_index: The position of the value in the write_sql parameters
+        :return: The value, None if not found
+        """
+        with self._lock:
+            # The most recent queued write wins
+            for pending_sql, pending_params in reversed(self._pending):
+                if pending_sql == write_sql and pending_params[:len(key)] == key:
+                    return pending_params[value_index]
+            row = self._connection.execute(sql, params).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def close(self):
+        """
+        Stop the flush thread, write the queued data and close the database
+        """
+        self._stop_event.set()
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+    # ---------------------------------------------
+    # Cookies
+    # ---------------------------------------------
+
+    def save_cookies(self, cookie_jar):
+        """
+        Replace the saved cookies with the content of the given jar
+        :param cookie_jar: The requests cookie jar to save
+        """
+        rows = [(cookie.name, cookie.domain, cookie.path, cookie.value, cookie.expires, int(bool(cookie.secure)))
+                for cookie in cookie_jar]
+        with self._lock:
+            self._pending_cookies = rows
+
+    def load_cookies(self, cookie_jar):
+        """
+        Add the saved cookies to the given jar
+        :param cookie_jar: The requests cookie jar to fill
+        :return: The number of loaded cookies
+        """
+        with self._lock:
+            self.flush()
+            rows = self._connection.execute(SQL_SELECT_COOKIES).fetchall()
+        for name, domain, path, value, expires, secure in rows:
+            cookie_jar.set(name, value, domain=domain, path=path, expires=expires, secure=bool(secure))
+        return len(rows)
+
+    # ---------------------------------------------
+    # Chat permissions
+    # ---------------------------------------------
+
+    def get_chat_admin(self, chat_id):
+        """
+        Return if the bot is admin in the given chat, according to the cache
+        :param chat_id: The id of the chat
+        :return: True or False if the cached value is still valid, None otherwise
+        """
+        is_admin = self._query_value(SQL_SELECT_CHAT_PERMISSION, (chat_id, time.time() - self.chat_permission_ttl),
+                                     SQL_UPSERT_CHAT_PERMISSION, (chat_id,), 1)
+        if is_admin is None:
+            return None
+        return bool(is_admin)
+
+    def set_chat_admin(self, chat_id, is_admin):
+        """
+        Cache if the bot is admin in the given chat
+        :param chat_id: The id of the chat
+        :param is_admin: True if the bot is admin in the chat
+        """
+        self._enqueue(SQL_UPSERT_CHAT_PERMISSION, (chat_id, int(is_admin), time.time()))
+
+    # ---------------------------------------------
+    # Stream checkpoints
+    # ---------------------------------------------
+
+    def get_checkpoint(self, stream):
+        """
+        Return the id of the last item processed by the given stream
+        :param stream: The name of the stream
+        :return: The id of the last item, None if the stream has never been processed
+        """
+        return self._query_value(SQL_SELECT_CHECKPOINT, (stream,), SQL_UPSERT_CHECKPOINT, (stream,), 1)
+
+    def set_checkpoint(self, stream, last_id):
+        """
+        Save the id of the last item processed by the given stream
+        :param stream: The name of the stream
+        :param last_id: The id of the last processed item
+        """
+        self._enqueue(SQL_UPSERT_CHECKPOINT, (stream, last_id, time.time()))
+
+    # ---------------------------------------------
+    # Title cache
+    # ---------------------------------------------
+
+    def get_title(self, url):
+        """
+        Return the cached title of the given page
+        :param url: The page url
+        :return: The title if cached and not expired, None otherwise
+        """
+        return self._query_value(SQL_SELECT_TITLE, (url, time.time() - self.title_ttl), SQL_UPSERT_TITLE, (url,), 1)
+
+    def set_title(self, url, title):
+        """
+        Cache the title of the given page
+        :param url: The page url
+        :param title: The page title
+        """
+        self._enqueue(SQL_UPSERT_TITLE, (url, title, time.time()))
+
+    # ---------------------------------------------
+    # Telegram message <-> Reddit submission map
+    # ---------------------------------------------
+
+    def add_message_submission(self, chat_id, message_id, submission_id):
+        """
+        Save that the given Telegram message refers to the given Reddit submission
+        :param chat_id: The id of the chat of the message
+        :param message_id: The id of the message
+        :param submission_id: The id of the Reddit submission
+        """
+        self._enqueue(SQL_UPSERT_MESSAGE_SUBMISSION, (chat_id, message_id, submission_id, time.time()))
+
+    def get_message_submission(self, chat_id, message_id):
+        """
+        Return the id of the Reddit submission the given Telegram message refers to
+        :param chat_id: The id of the chat of the message
+        :param message_id: The id of the message
+        :return: The submission id, None if the message is not mapped
+        """
+        return self._query_value(SQL_SELECT_MESSAGE_SUBMISSION, (chat_id, message_id),
+                                 SQL_UPSERT_MESSAGE_SUBMISSION, (chat_id, message_id), 2)
+
+    def get_submission_messages(self, submission_id):
+        """
+        Return all the Telegram messages that refer to the given Reddit submission
+        :param submission_id: The id of the Reddit submission
+        :return: A list of (chat_id, message_id) tuples
+        """
+        with self._lock:
+            self.flush()
+            return self._connection.execute(SQL_SELECT_SUBMISSION_MESSAGES, (submission_id,)).fetchall()